@@ -14,7 +14,9 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 from XQuery import XQuery
-import os, httplib, urlparse, base64
+from StagedWrite import StagedWrite
+from util import parallel
+import os, fnmatch, httplib, urllib, urlparse, base64
 try:
     from lxml import etree
 except ImportError:
@@ -27,6 +29,7 @@ class ExistDB(object):
     The eXist-db connection object.
     """
     RESULT_NS = 'http://exist.sourceforge.net/NS/exist'
+    MANIFEST  = '.pyexist-manifest'
 
     class Error(Exception):
         pass
@@ -128,8 +131,12 @@ class ExistDB(object):
             raise ExistDB.Error('Error %d: %s' % (errcode, errmsg))
         conn.close()
 
-    def _post(self, thequery, start = 1, max = None):
-        thequery = package_query(thequery)
+    def _post(self, thequery, start = 1, max = None, cache = False, session = None):
+        thequery = package_query(thequery,
+                                 start,
+                                 max,
+                                 cache   = cache,
+                                 session = session)
         conn     = self._get_connection('POST', self.path)
         conn.putheader('Content-Type',   'text/xml')
         conn.putheader('Content-Length', str(len(thequery)))
@@ -144,6 +151,16 @@ class ExistDB(object):
         conn.close()
         return response
 
+    def _release(self, session):
+        path = self.path + '?_release=' + urllib.quote(str(session))
+        conn = self._get_connection('GET', path)
+        conn.endheaders()
+
+        errcode, errmsg, headers = conn.getreply()
+        if errcode != 200:
+            raise ExistDB.Error('Error %d: %s' % (errcode, errmsg))
+        conn.close()
+
     def query(self, thequery, **kwargs):
         """
         Creates a new query object from the given xquery statement.
@@ -215,30 +232,81 @@ class ExistDB(object):
 
     def rename(self, resource, new_name):
         """
-        Renames the given document (without moving it).
+        Renames the given document or collection (without moving it).
 
         @type  resource: string
-        @param resource: Document name in database.
+        @param resource: Document or collection name in database.
         @type  new_name: string
         @param new_name: The new name.
         """
         xquery = '''
-        let $status := xmldb:rename('%{collection}', '%{resource}', '%{newname}')
-        return <status>{$status}</status>
+        if (xmldb:collection-available('%{path}'))
+        then
+            (: The resource is a collection name :)
+            let $status := xmldb:rename('%{path}', '%{newname}')
+            return <status>{$status}</status>
+        else
+            (: The resource is a document name :)
+            let $status := xmldb:rename('%{collection}', '%{resource}', '%{newname}')
+            return <status>{$status}</status>
         '''
         if self.collection and not resource.startswith('/'):
             resource = self.collection + '/' + resource
+        path = resource
         try:
             collection, resource = resource.rsplit('/', 1)
         except ValueError:
             collection = ''
         query = self.query(xquery,
+                           path       = path,
                            collection = collection,
                            resource   = resource,
                            newname    = new_name)
         query.execute()
         return query
 
+    def exists(self, name):
+        """
+        Returns True if a document or collection with the given name
+        exists, False otherwise.
+
+        @type  name: string
+        @param name: Document or collection name in database.
+        @rtype:  bool
+        @return: Whether the document or collection exists.
+        """
+        xquery = '''
+        <status>{
+            xmldb:collection-available('%{name}')
+            or doc-available('%{name}')
+        }</status>
+        '''
+        if self.collection and not name.startswith('/'):
+            name = self.collection + '/' + name
+        tree = XQuery(self, xquery, name = name).execute()
+        return tree.findtext('status') == 'true'
+
+    def staged(self, collection, threads = 4):
+        """
+        Returns a context manager that collects documents and publishes
+        them as the new content of the given collection when the block
+        is left without an error::
+
+            with db.staged('mycollection') as staging:
+                staging.store('doc1', xml1)
+                staging.store_file('doc2.xml')
+
+        See StagedWrite for details.
+
+        @type  collection: string
+        @param collection: Collection name in database.
+        @type  threads: int
+        @param threads: The number of parallel uploads.
+        @rtype:  StagedWrite
+        @return: A new StagedWrite instance.
+        """
+        return StagedWrite(self, collection, threads)
+
     def copy(self, source, destination):
         """
         Copies the given source document to the given destination.
@@ -277,7 +345,204 @@ class ExistDB(object):
         query.execute()
         return query
 
-def package_query(xquery, start = 1, limit = None, pretty_xml = False):
+    def _list_resources(self, collection):
+        """
+        Returns a dict that maps the names of all resources in the given
+        collection (recursively, relative to the collection) to their
+        last-modified time in seconds since the epoch. The listing is
+        fetched using a single query.
+        """
+        xquery = '''
+        declare function local:list($col as xs:string, $prefix as xs:string) {
+            for $res in xmldb:get-child-resources($col)
+            let $modified := xmldb:last-modified($col, $res)
+                           - xs:dateTime('1970-01-01T00:00:00Z')
+            return <resource name="{concat($prefix, $res)}"
+                             modified="{$modified div xs:dayTimeDuration('PT1S')}"/>,
+            for $child in xmldb:get-child-collections($col)
+            return local:list(concat($col, '/', $child),
+                              concat($prefix, $child, '/'))
+        };
+        if (xmldb:collection-available('%{collection}'))
+        then <resources>{local:list('%{collection}', '')}</resources>
+        else <resources/>
+        '''
+        if self.collection and not collection.startswith('/'):
+            collection = (self.collection + '/' + collection).rstrip('/')
+        if not collection:
+            collection = '/db'
+        tree      = XQuery(self, xquery, collection = collection).execute()
+        resources = {}
+        for elem in tree.iter('resource'):
+            resources[elem.get('name')] = float(elem.get('modified'))
+        return resources
+
+    def sync_dir(self,
+                 path,
+                 collection     = '',
+                 pattern        = '*.xml',
+                 dry_run        = False,
+                 threads        = 4,
+                 keep_extension = False,
+                 manifest       = None):
+        """
+        Makes the given collection mirror the files in the given local
+        directory (recursively), by uploading only files that are new or
+        have changed, and deleting resources whose file was removed.
+        Only files matching the given pattern are considered.
+
+        Like store_file(), documents are named after the file with the
+        extension removed, unless keep_extension is True.
+
+        Changes are detected using a manifest file that records the MD5
+        sum of every file that was synced to the target. By default, it
+        is stored in the directory, using a name that starts with
+        ExistDB.MANIFEST and that is unique for the server and the
+        collection. Files that have no manifest entry are uploaded if
+        their modification time is newer than that of the resource in
+        the database. Only resources that have a manifest entry, but no
+        longer have a file, are deleted; other resources in the
+        collection are left alone.
+
+        @type  path: string
+        @param path: The local directory.
+        @type  collection: string
+        @param collection: Collection name in database.
+        @type  pattern: string
+        @param pattern: A shell-style pattern for the file names.
+        @type  dry_run: bool
+        @param dry_run: If True, only determine what would be changed.
+        @type  threads: int
+        @param threads: The number of parallel uploads.
+        @type  keep_extension: bool
+        @param keep_extension: Whether to keep file extensions in the
+            document names.
+        @type  manifest: string
+        @param manifest: The name of the manifest file.
+        @rtype:  tuple(list, list)
+        @return: The names of the uploaded and the deleted documents.
+        """
+        prefix = collection.strip('/')
+        if prefix:
+            prefix += '/'
+        if manifest is None:
+            target   = self.netloc + self.path + '/' + prefix
+            manifest = os.path.join(path, '%s-%s' % (self.MANIFEST,
+                                                     _md5_string(target)))
+        manifest_file = os.path.abspath(manifest)
+        manifest      = _read_manifest(manifest_file)
+        remote        = self._list_resources(collection)
+
+        # Find the files that are new or that have changed.
+        local  = {}
+        upload = []
+        for dirname, dirs, files in os.walk(path):
+            reldir = dirname[len(path):].strip(os.sep).replace(os.sep, '/')
+            for filename in fnmatch.filter(files, pattern):
+                if filename.startswith(self.MANIFEST):
+                    continue
+                if os.path.abspath(os.path.join(dirname, filename)) \
+                  == manifest_file:
+                    continue
+                name = filename
+                if not keep_extension:
+                    name = os.path.splitext(name)[0]
+                if reldir:
+                    name = reldir + '/' + name
+                filename    = os.path.join(dirname, filename)
+                mtime       = os.path.getmtime(filename)
+                local[name] = filename
+                if name in manifest and manifest[name][1] == mtime:
+                    if name not in remote:
+                        upload.append(name)
+                    continue
+                md5 = _md5_file(filename)
+                if name not in remote:
+                    upload.append(name)
+                elif name in manifest:
+                    if manifest[name][0] != md5:
+                        upload.append(name)
+                elif mtime > remote[name]:
+                    upload.append(name)
+                manifest[name] = md5, mtime
+        delete = [n for n in manifest if n not in local and n in remote]
+        upload.sort()
+        delete.sort()
+        if dry_run:
+            return upload, delete
+
+        # Apply the changes.
+        def store(name):
+            xml = open(local[name]).read()
+            self.store(urllib.quote(prefix + name), xml)
+        def delete_doc(name):
+            self.delete(urllib.quote(prefix + name))
+        errors  = parallel(store, upload, threads)
+        errors += parallel(delete_doc, delete, threads)
+        failed  = set([n for n, e in errors])
+        for name in manifest.keys():
+            if name not in local and name not in failed:
+                del manifest[name]
+        for name in upload:
+            if name in failed:
+                manifest[name] = '', 0   # Force an upload in the next run.
+        _write_manifest(manifest_file, manifest)
+
+        if errors:
+            msg = ', '.join(['%s (%s)' % (n, e) for n, e in errors])
+            raise ExistDB.Error('sync failed for ' + msg)
+        return upload, delete
+
+def _md5():
+    try:
+        from hashlib import md5
+    except ImportError:
+        from md5 import md5
+    return md5()
+
+def _md5_string(string):
+    digest = _md5()
+    digest.update(string)
+    return digest.hexdigest()
+
+def _md5_file(filename):
+    digest = _md5()
+    file   = open(filename, 'rb')
+    try:
+        for chunk in iter(lambda: file.read(65536), ''):
+            digest.update(chunk)
+    finally:
+        file.close()
+    return digest.hexdigest()
+
+def _read_manifest(filename):
+    """
+    Reads a manifest as written by _write_manifest(). Returns a dict that
+    maps document names to (md5, mtime) tuples.
+    """
+    manifest = {}
+    if not os.path.isfile(filename):
+        return manifest
+    for line in open(filename):
+        md5, mtime, name = line.rstrip('\n').split(' ', 2)
+        manifest[name] = md5, float(mtime)
+    return manifest
+
+def _write_manifest(filename, manifest):
+    file = open(filename, 'w')
+    try:
+        for name in sorted(manifest):
+            md5, mtime = manifest[name]
+            file.write('%s %r %s\n' % (md5 or '-', mtime, name))
+    finally:
+        file.close()
+
+def package_query(xquery,
+                  start      = 1,
+                  limit      = None,
+                  pretty_xml = False,
+                  cache      = False,
+                  session    = None):
     '''
     Package up XQuery in a <query> XML tree
 
@@ -285,6 +550,10 @@ def package_query(xquery, start = 1, limit = None, pretty_xml = False):
     @param start: The offset of the first returned item.
     @type  limit: int or None
     @param limit: The maximum number of results.
+    @type  cache: bool
+    @param cache: Whether the server should keep the result in a session.
+    @type  session: string or None
+    @param session: The id of a session that holds the result.
     @rtype:  string
     @return: The resulting XML.
     '''
@@ -301,6 +570,10 @@ def package_query(xquery, start = 1, limit = None, pretty_xml = False):
     root.setAttribute('xmlns', xmlns)
     root.setAttribute('max',   str(limit))
     root.setAttribute('start', str(start))
+    if cache:
+        root.setAttribute('cache', 'yes')
+    if session is not None:
+        root.setAttribute('session-id', str(session))
 
     # Add the XQuery into it.
     elem = doc.createElement('text')
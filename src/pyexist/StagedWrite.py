@@ -0,0 +1,198 @@
+# Copyright (C) 2010 Samuel Abels.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+import os, uuid, warnings
+from util import WorkerPool
+
+class StagedWrite(object):
+    """
+    Collects documents and publishes them as the new content of a
+    collection in one step. You normally don't want to create a
+    StagedWrite instance directly, try using ExistDB.staged() instead.
+
+    Documents are uploaded into a temporary collection next to the target
+    collection as soon as they are stored, using a pool of worker threads;
+    store() blocks while too many documents wait for an upload. On commit,
+    the temporary collection is renamed to replace the target collection,
+    so that readers never see a half-updated collection. If any upload
+    fails, the remaining uploads are skipped, further calls to store()
+    raise an error, and the temporary collection is removed on commit or
+    rollback; the target is left untouched.
+
+    Note that the target collection is replaced as a whole; documents
+    that were not stored using this object are no longer in it after the
+    commit.
+    """
+    def __init__(self, db, collection, threads = 4):
+        """
+        Use ExistDB.staged() instead of creating a StagedWrite directly.
+
+        @type  db: ExistDB
+        @param db: The parent database instance.
+        @type  collection: string
+        @param collection: Collection name in database.
+        @type  threads: int
+        @param threads: The number of parallel uploads.
+        """
+        if threads < 1:
+            raise ValueError('at least one thread is required')
+        collection = collection.rstrip('/')
+        try:
+            parent, name = collection.rsplit('/', 1)
+            parent      += '/'
+        except ValueError:
+            parent = ''
+            name   = collection
+        token           = uuid.uuid4().hex[:12]
+        self.db         = db
+        self.collection = collection
+        self.threads    = threads
+        self.name       = name
+        self.staging    = parent + name + '.staging-' + token
+        self.backup     = parent + name + '.backup-' + token
+        self.pool       = None
+        self.uploaded   = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+            return False
+
+        # Do not hide the original exception.
+        try:
+            self.rollback()
+        except Exception:
+            pass
+        return False
+
+    def _error(self, errors):
+        msg = ', '.join(['%s (%s)' % (d[0], e) for d, e in errors])
+        return self.db.Error('staged write failed for ' + msg)
+
+    def _put(self, document):
+        if self.pool is None:
+            self.pool = WorkerPool(self._upload,
+                                   self.threads,
+                                   stop_on_error = True)
+        if self.pool.errors:
+            raise self._error(self.pool.errors)
+        self.pool.put(document)
+
+    def store(self, docname, xml):
+        """
+        Uploads the given XML into the temporary collection. Arguments
+        are the same as for ExistDB.store(). Raises an error if a
+        previous upload failed.
+
+        @type  docname: string
+        @param docname: Document name in the collection.
+        @type  xml: string or lxml.ElementTree
+        @param xml: XML document to import.
+        """
+        self._put((docname, xml, None))
+
+    def store_file(self, filename, docname = None):
+        """
+        Like store(), but reads the XML from a file instead. The file is
+        not read before the upload starts. If the document name is None,
+        it defaults to the basename of the file, with the .xml extension
+        removed.
+
+        @type  filename: string
+        @param filename: The name of an XML file.
+        @type  docname: string
+        @param docname: A document name.
+        """
+        if docname is None:
+            docname = os.path.splitext(os.path.basename(filename))[0]
+        self._put((docname, None, filename))
+
+    def _upload(self, document):
+        docname, xml, filename = document
+        if filename is not None:
+            xml = open(filename).read()
+        self.uploaded = True
+        self.db.store(self.staging + '/' + docname, xml)
+
+    def commit(self):
+        """
+        Waits until all staged documents are uploaded, then swaps the
+        temporary collection into place of the target collection.
+        Does nothing if no documents were staged. If the previous content
+        can not be removed afterwards, a warning is issued.
+        """
+        if self.pool is None:
+            return
+        errors    = self.pool.join()
+        self.pool = None
+        if errors:
+            self.rollback()
+            raise self._error(errors)
+
+        # Move the current content out of the way.
+        try:
+            have_backup = self.db.exists(self.collection)
+            if have_backup:
+                self.db.rename(self.collection,
+                               self.backup.rsplit('/', 1)[-1])
+        except self.db.Error:
+            self.rollback()
+            raise
+
+        # Publish.
+        try:
+            self.db.rename(self.staging, self.name)
+        except self.db.Error, e:
+            if have_backup:
+                try:
+                    self.db.rename(self.backup, self.name)
+                except self.db.Error, restore_error:
+                    msg = 'publishing %s failed (%s), and restoring the' \
+                        + ' previous content from %s failed: %s'
+                    raise self.db.Error(msg % (self.collection,
+                                               e,
+                                               self.backup,
+                                               restore_error))
+            self.rollback()
+            raise
+        self.uploaded = False
+
+        # The new content is published at this point, so failing to clean
+        # up is not an error of the commit.
+        if have_backup:
+            try:
+                self.db.delete(self.backup)
+            except self.db.Error, e:
+                warnings.warn('removing the previous content of %s in %s'
+                              ' failed: %s' % (self.collection,
+                                               self.backup,
+                                               e))
+
+    def rollback(self):
+        """
+        Discards all staged documents, and removes the temporary
+        collection if any document was uploaded.
+        """
+        if self.pool is not None:
+            self.pool.cancel()
+            self.pool.join()
+            self.pool = None
+        if not self.uploaded:
+            return
+        self.uploaded = False
+        if self.db.exists(self.staging):
+            self.db.delete(self.staging)
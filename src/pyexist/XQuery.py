@@ -23,6 +23,8 @@ class XQuery(object):
     is requested using either the slice notation (such as query[0], or
     query[1:20]) or calling one of the count() or length methods.
     """
+    EXPORT_FORMATS = ('xml', 'ndjson', 'csv')
+
     def __init__(self, db, query, **kwargs):
         """
         Use ExistDB.query() instead of creating a query directly.
@@ -34,9 +36,11 @@ class XQuery(object):
         @type  kwargs: dict
         @param kwargs: Parameters to pass into the query.
         """
-        self.db    = db
-        self.query = replacetags(query, **kwargs)
-        self.len   = None
+        self.db      = db
+        self.query   = replacetags(query, **kwargs)
+        self.len     = None
+        self.cache   = False
+        self.session = None
 
     @staticmethod
     def fromfile(db, filename, **kwargs):
@@ -94,6 +98,213 @@ class XQuery(object):
         """
         return self[:]
 
+    def pages(self, page_size = 1000, prefetch = 0):
+        """
+        Iterates over the result in pages of the given size, requesting
+        one page from the server at a time. Each page is the XML tree
+        returned by the slice notation.
+
+        If prefetch is greater than zero, pages are requested by a
+        background thread while the caller processes the current page.
+        At most the given number of pages is fetched ahead; the thread
+        waits while that many pages are not yet consumed.
+
+        @type  page_size: int
+        @param page_size: The maximum number of items per request.
+        @type  prefetch: int
+        @param prefetch: The number of pages to fetch in advance.
+        @rtype:  iterator
+        @return: An iterator over XML trees.
+        """
+        if prefetch > 0:
+            return self._prefetch_pages(page_size, prefetch)
+        return self._pages(page_size)
+
+    def _pages(self, page_size):
+        # Have the server keep the result in a session, so that the
+        # query is not evaluated again for every page.
+        self.cache = True
+        try:
+            start = 0
+            while True:
+                tree = self[start:start + page_size]
+                if len(tree) == 0:
+                    break
+                yield tree
+                start += len(tree)
+                if start >= self.len:
+                    break
+        finally:
+            self.cache = False
+            self._release_session()
+
+    def _release_session(self):
+        session, self.session = self.session, None
+        if session is None:
+            return
+
+        # The server drops the session after a timeout anyway, so do not
+        # hide the result or the original error.
+        try:
+            self.db._release(session)
+        except self.db.Error:
+            pass
+
+    def _prefetch_pages(self, page_size, prefetch):
+        import sys, threading
+        from Queue import Queue, Full
+
+        queue = Queue(prefetch)
+        stop  = threading.Event()
+        done  = object()
+
+        def put(item):
+            # Time out regularly, so the thread notices when the consumer
+            # stops iterating early.
+            while not stop.isSet():
+                try:
+                    queue.put(item, True, 0.1)
+                except Full:
+                    continue
+                return True
+            return False
+
+        def fetch():
+            pages = self._pages(page_size)
+            try:
+                try:
+                    for tree in pages:
+                        if not put(tree):
+                            return
+                except Exception:
+                    put(sys.exc_info())
+                    return
+            finally:
+                pages.close()
+            put(done)
+
+        thread = threading.Thread(target = fetch)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is done:
+                    break
+                if isinstance(item, tuple):
+                    raise item[0], item[1], item[2]
+                yield item
+        finally:
+            stop.set()
+
+    def prefetch(self, page_size = 1000, depth = 2):
+        """
+        Like iterating over the query, but requests the result one page
+        at a time, fetching the next pages in a background thread while
+        the caller processes the items of the current page.
+
+        @type  page_size: int
+        @param page_size: The maximum number of items per request.
+        @type  depth: int
+        @param depth: The number of pages to fetch in advance.
+        @rtype:  iterator
+        @return: An iterator over all result elements.
+        """
+        for tree in self.pages(page_size, max(1, depth)):
+            for elem in tree:
+                yield elem
+
+    def export(self,
+               fileobj,
+               format    = 'xml',
+               fields    = None,
+               page_size = 1000,
+               progress  = None,
+               prefetch  = 0):
+        """
+        Writes the result to the given file object, one page at a time,
+        so that the complete result is never held in memory.
+
+        The following formats are supported:
+
+          - 'xml': The result elements, wrapped in an exist:result element.
+          - 'ndjson': One JSON object per line for each result element.
+          - 'csv': One row per result element, with a header row.
+
+        For 'ndjson' and 'csv', each result element is converted using the
+        given list of field names. A field name starting with '@' selects
+        an attribute, any other name is passed to findtext() and may
+        therefore be a path. If no fields are given, all attributes and
+        the text of all child elements are used; for 'csv', the columns
+        are then taken from the first result element.
+
+        @type  fileobj: file
+        @param fileobj: An open file-like object.
+        @type  format: string
+        @param format: One of 'xml', 'ndjson' or 'csv'.
+        @type  fields: list(string)
+        @param fields: The names of the fields to export.
+        @type  page_size: int
+        @param page_size: The maximum number of items per request.
+        @type  progress: callable
+        @param progress: Called as progress(n, total) after each page.
+        @type  prefetch: int
+        @param prefetch: The number of pages to fetch in advance.
+        @rtype:  int
+        @return: The number of exported items.
+        """
+        if format not in self.EXPORT_FORMATS:
+            raise ValueError('unsupported export format ' + repr(format))
+        import copy
+        from lxml import etree
+        if format == 'ndjson':
+            try:
+                import json
+            except ImportError:
+                import simplejson as json
+        elif format == 'csv':
+            import csv
+            writer = None
+
+        def write_header():
+            # The number of hits is known once the first page arrived.
+            fileobj.write('<exist:result xmlns:exist="%s" exist:hits="%d">\n'
+                          % (self.db.RESULT_NS, self.len or 0))
+
+        count = 0
+        for tree in self.pages(page_size, prefetch):
+            if format == 'xml' and count == 0:
+                write_header()
+            for elem in tree:
+                if format == 'xml':
+                    # Drop the namespace declarations that the element
+                    # inherited from the response.
+                    elem = copy.deepcopy(elem)
+                    etree.cleanup_namespaces(elem)
+                    fileobj.write(etree.tostring(elem,
+                                                 encoding = 'utf-8',
+                                                 xml_declaration = False,
+                                                 with_tail = False))
+                    fileobj.write('\n')
+                    continue
+                row = _element_to_dict(elem, fields)
+                if format == 'ndjson':
+                    fileobj.write(json.dumps(row) + '\n')
+                    continue
+                if writer is None:
+                    fields = fields or sorted(row.keys())
+                    writer = csv.writer(fileobj)
+                    writer.writerow(fields)
+                writer.writerow([_encode(row.get(f)) for f in fields])
+            count += len(tree)
+            if progress is not None:
+                progress(count, self.len)
+        if format == 'xml':
+            if count == 0:
+                write_header()
+            fileobj.write('</exist:result>\n')
+        return count
+
     def _getitem_post(self, key):
         """
         Produces the query to request the given range of items
@@ -122,7 +333,11 @@ class XQuery(object):
         else:
             raise TypeError('invalid key argument ' + repr(key))
 
-        return self.db._post(self.query, start = start, max = max)
+        return self.db._post(self.query,
+                             start   = start,
+                             max     = max,
+                             cache   = self.cache,
+                             session = self.session)
 
     def __getitem__(self, key):
         """
@@ -147,4 +362,41 @@ class XQuery(object):
                               + 'in response to ' + self.query)
 
         self.len = int(tree.get('{' + self.db.RESULT_NS + '}hits'))
+        if self.cache:
+            self.session = tree.get('{' + self.db.RESULT_NS + '}session',
+                                    self.session)
         return tree
+
+def _localname(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _element_to_dict(elem, fields = None):
+    """
+    Converts the given result element into a dict, as described in
+    XQuery.export().
+    """
+    if fields is not None:
+        row = {}
+        for field in fields:
+            if field.startswith('@'):
+                row[field] = elem.get(field[1:])
+            else:
+                row[field] = elem.findtext(field)
+        return row
+
+    row = {}
+    for key, value in elem.attrib.iteritems():
+        row['@' + _localname(key)] = value
+    children = [c for c in elem if isinstance(c.tag, basestring)]
+    for child in children:
+        row[_localname(child.tag)] = child.text
+    if not children and elem.text and elem.text.strip():
+        row[_localname(elem.tag)] = elem.text
+    return row
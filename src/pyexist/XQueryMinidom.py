@@ -44,5 +44,7 @@ class XQueryMinidom(XQuery):
                               + 'in response to ' + self.query)
 
         self.len = int(root.getAttribute('exist:hits'))
+        if self.cache:
+            self.session = root.getAttribute('exist:session') or self.session
         result   = root.getElementsByTagName('result')[0]
         return result
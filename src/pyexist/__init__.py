@@ -19,3 +19,4 @@ from version       import __version__
 from ExistDB       import ExistDB
 from XQuery        import XQuery
 from XQueryMinidom import XQueryMinidom
+from StagedWrite   import StagedWrite
@@ -21,3 +21,111 @@ def replacetags(string, **kwargs):
     for key, value in kwargs.iteritems():
         string = string.replace('%{' + key + '}', escape(value))
     return string
+
+class WorkerPool(object):
+    """
+    Calls a function for each item that is passed to put(), using a pool
+    of worker threads. The number of items that wait for a free worker is
+    bounded; put() blocks while the backlog is full. Errors are collected
+    and returned by join(); unless stop_on_error is True, they do not
+    stop the workers.
+    """
+    _stop = object()
+
+    def __init__(self,
+                 func,
+                 threads       = 4,
+                 backlog       = None,
+                 stop_on_error = False):
+        """
+        Creates the pool and starts the worker threads.
+
+        @type  func: callable
+        @param func: The function to call for each item.
+        @type  threads: int
+        @param threads: The number of worker threads.
+        @type  backlog: int
+        @param backlog: The maximum number of waiting items; defaults to
+            twice the number of threads.
+        @type  stop_on_error: bool
+        @param stop_on_error: Whether to cancel() the pool on the first
+            error.
+        """
+        import threading
+        from Queue import Queue
+        if threads < 1:
+            raise ValueError('at least one thread is required')
+        self.func          = func
+        self.queue         = Queue(backlog or 2 * threads)
+        self.errors        = []
+        self.cancelled     = False
+        self.stop_on_error = stop_on_error
+        self.workers   = [threading.Thread(target = self._worker)
+                          for i in range(threads)]
+        for thread in self.workers:
+            thread.setDaemon(True)
+            thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is self._stop:
+                return
+            if self.cancelled:
+                continue
+            try:
+                self.func(item)
+            except Exception, e:
+                self.errors.append((item, e))
+                if self.stop_on_error:
+                    self.cancel()
+
+    def put(self, item):
+        """
+        Schedules a call for the given item.
+
+        @type  item: object
+        @param item: The item to pass to the function.
+        """
+        self.queue.put(item)
+
+    def cancel(self):
+        """
+        Skips all items that were not yet started. Items that are
+        currently processed are completed.
+        """
+        self.cancelled = True
+
+    def join(self):
+        """
+        Waits until all items were processed and stops the workers.
+
+        @rtype:  list
+        @return: A list of (item, exception) tuples.
+        """
+        for thread in self.workers:
+            self.queue.put(self._stop)
+        for thread in self.workers:
+            thread.join()
+        return self.errors
+
+def parallel(func, items, threads = 4):
+    """
+    Calls func(item) for each of the given items, using the given number
+    of worker threads. Errors do not abort the remaining calls; instead,
+    a list of (item, exception) tuples is returned for every call that
+    failed.
+
+    @type  func: callable
+    @param func: The function to call for each item.
+    @type  items: list
+    @param items: The items to pass to the function.
+    @type  threads: int
+    @param threads: The maximum number of worker threads.
+    @rtype:  list
+    @return: A list of (item, exception) tuples.
+    """
+    pool = WorkerPool(func, max(1, min(threads, len(items))))
+    for item in items:
+        pool.put(item)
+    return pool.join()
@@ -0,0 +1,173 @@
+import sys, unittest, re, os.path, shutil, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from pyexist import ExistDB
+from pyexist.ExistDB import _read_manifest, _write_manifest, _md5_file
+
+class ExistDBTest(unittest.TestCase):
+    def setUp(self):
+        self.dir     = tempfile.mkdtemp()
+        self.db      = ExistDB('localhost:8080/exist/rest/db', 'col')
+        self.remote  = {}
+        self.stored  = []
+        self.deleted = []
+        self.db._list_resources = lambda collection: self.remote
+        self.db.store           = lambda name, xml: self.stored.append(name)
+        self.db.delete          = lambda name: self.deleted.append(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, content):
+        filename = os.path.join(self.dir, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        open(filename, 'w').write(content)
+        return filename
+
+    def testManifest(self):
+        filename = os.path.join(self.dir, 'manifest')
+        self.assertEqual(_read_manifest(filename), {})
+
+        manifest = {'a':         ('0123', 1.5),
+                    'sub/b c':   ('4567', 1234567890.25),
+                    'failed':    ('', 0)}
+        _write_manifest(filename, manifest)
+        result = _read_manifest(filename)
+        self.assertEqual(result['a'],       ('0123', 1.5))
+        self.assertEqual(result['sub/b c'], ('4567', 1234567890.25))
+        self.assertNotEqual(result['failed'][0], _md5_file(filename))
+        self.assertEqual(len(result), 3)
+
+    def testListResources(self):
+        ns      = ExistDB.RESULT_NS
+        queries = []
+        def post(query, start = 1, max = None, **kwargs):
+            queries.append(query)
+            return '<exist:result xmlns:exist="%s" exist:hits="1">' \
+                   '<resources><resource name="sub/a" modified="12.5"/>' \
+                   '</resources></exist:result>' % ns
+
+        # An empty collection name refers to the database root.
+        db       = ExistDB('localhost:8080/exist/rest/db')
+        db._post = post
+        self.assertEqual(db._list_resources(''), {'sub/a': 12.5})
+        self.assert_("xmldb:collection-available('/db')" in queries[-1])
+
+        db       = ExistDB('localhost:8080/exist/rest/db', 'col')
+        db._post = post
+        db._list_resources('sub')
+        self.assert_("xmldb:collection-available('col/sub')" in queries[-1])
+
+    def _manifests(self):
+        return [f for f in os.listdir(self.dir)
+                if f.startswith(ExistDB.MANIFEST)]
+
+    def testSyncDir(self):
+        self._write('a.xml',       '<a/>')
+        self._write('sub/b.xml',   '<b/>')
+        self._write('sub/x y.xml', '<c/>')
+        self._write('skipped.txt', 'foo')
+        self.remote = {'a':               1e12,
+                       'README.txt':      1.0,
+                       'config.xconf':    1.0,
+                       'images/logo.png': 1.0,
+                       'unknown':         1.0}
+
+        # Dry run. "a" is newer in the database and has no manifest entry.
+        # Resources that were not synced before are never deleted.
+        upload, delete = self.db.sync_dir(self.dir, 'dst', dry_run = True)
+        self.assertEqual(upload, ['sub/b', 'sub/x y'])
+        self.assertEqual(delete, [])
+        self.assertEqual(self.stored,  [])
+        self.assertEqual(self._manifests(), [])
+
+        # Sync.
+        upload, delete = self.db.sync_dir(self.dir, 'dst')
+        self.assertEqual(sorted(self.stored), ['dst/sub/b', 'dst/sub/x%20y'])
+        self.assertEqual(self.deleted, [])
+        manifests = self._manifests()
+        self.assertEqual(len(manifests), 1)
+        manifest = _read_manifest(os.path.join(self.dir, manifests[0]))
+        self.assertEqual(sorted(manifest), ['a', 'sub/b', 'sub/x y'])
+
+        # Nothing changed.
+        self.remote.update({'sub/b': 1.0, 'sub/x y': 1.0})
+        self.assertEqual(self.db.sync_dir(self.dir, 'dst'), ([], []))
+
+        # Changed content is detected through the manifest.
+        filename = self._write('a.xml', '<a>changed</a>')
+        os.utime(filename, (1, 1))
+        self.assertEqual(self.db.sync_dir(self.dir, 'dst'), (['a'], []))
+
+        # Removed files are deleted.
+        shutil.rmtree(os.path.join(self.dir, 'sub'))
+        upload, delete = self.db.sync_dir(self.dir, 'dst')
+        self.assertEqual(upload, [])
+        self.assertEqual(delete, ['sub/b', 'sub/x y'])
+        self.assertEqual(self.db.sync_dir(self.dir, 'dst'), ([], []))
+
+    def testSyncDirTargets(self):
+        filename    = self._write('a.xml', '<a/>')
+        self.remote = {'a': 1.0}
+        self.assertEqual(self.db.sync_dir(self.dir, 'dst1'), (['a'], []))
+
+        # Syncing a change to one target leaves the other one stale.
+        self.assertEqual(self.db.sync_dir(self.dir, 'dst2'), (['a'], []))
+        self._write('a.xml', '<a>changed</a>')
+        os.utime(filename, (2, 2))
+        self.assertEqual(self.db.sync_dir(self.dir, 'dst1'), (['a'], []))
+        self.assertEqual(self.db.sync_dir(self.dir, 'dst2'), (['a'], []))
+        self.assertEqual(len(self._manifests()), 2)
+
+        # The manifest file name can be chosen.
+        manifest = os.path.join(self.dir, 'my-manifest')
+        self.assertEqual(self.db.sync_dir(self.dir,
+                                          'dst3',
+                                          pattern  = '*',
+                                          manifest = manifest),
+                         (['a'], []))
+        self.assertEqual(sorted(_read_manifest(manifest)), ['a'])
+
+    def testSyncDirSkipsManifest(self):
+        self._write('a.xml', '<a/>')
+        self.db.sync_dir(self.dir)
+        self.remote = {'a': 1.0}
+        self.assertEqual(self.db.sync_dir(self.dir, pattern = '*'), ([], []))
+
+    def testSyncDirKeepExtension(self):
+        self._write('a.xml', '<a/>')
+        self.remote = {'a': 1.0}
+        upload, delete = self.db.sync_dir(self.dir, keep_extension = True)
+        self.assertEqual(upload, ['a.xml'])
+        self.assertEqual(self.stored, ['a.xml'])
+
+    def testSyncDirErrors(self):
+        self._write('a.xml', '<a/>')
+        self._write('b.xml', '<b/>')
+        def store(name, xml):
+            if name == 'b':
+                raise ExistDB.Error('failed')
+            self.stored.append(name)
+        self.db.store = store
+        self.assertRaises(ExistDB.Error, self.db.sync_dir, self.dir)
+        self.assertEqual(self.stored, ['a'])
+
+        # The failed document is uploaded again in the next run.
+        self.db.store = lambda name, xml: self.stored.append(name)
+        self.remote   = {'a': 1.0, 'b': 1.0}
+        self.assertEqual(self.db.sync_dir(self.dir), (['b'], []))
+
+        # A failed deletion is retried in the next run.
+        os.remove(os.path.join(self.dir, 'a.xml'))
+        def delete(name):
+            raise ExistDB.Error('failed')
+        self.db.delete = delete
+        self.assertRaises(ExistDB.Error, self.db.sync_dir, self.dir)
+        self.db.delete = self.deleted.append
+        self.assertEqual(self.db.sync_dir(self.dir), ([], ['a']))
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ExistDBTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
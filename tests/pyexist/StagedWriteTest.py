@@ -0,0 +1,189 @@
+from __future__ import with_statement
+import sys, unittest, re, os.path, tempfile, threading, time, warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from pyexist import ExistDB, StagedWrite
+
+class StagedWriteTest(unittest.TestCase):
+    CORRELATE = StagedWrite
+
+    def setUp(self):
+        self.db       = ExistDB('localhost:8080/exist/rest/db', 'col')
+        self.log      = []
+        self.existing = set(['a/data'])
+        self.lock     = threading.Lock()
+        self.db.store  = self._store
+        self.db.delete = self._delete
+        self.db.rename = self._rename
+        self.db.exists = lambda name: name in self.existing
+        self.staging   = StagedWrite(self.db, 'a/data', threads = 2)
+
+    def _store(self, name, xml):
+        self.lock.acquire()
+        self.log.append(('store', name, xml))
+        self.existing.add(name.rsplit('/', 1)[0])
+        self.lock.release()
+
+    def _delete(self, name):
+        self.log.append(('delete', name))
+        self.existing.discard(name)
+
+    def _rename(self, name, new_name):
+        self.log.append(('rename', name, new_name))
+
+    def testConstructor(self):
+        self.assertEqual(self.staging.collection, 'a/data')
+        self.assertEqual(self.staging.name, 'data')
+        self.assert_(self.staging.staging.startswith('a/data.staging-'))
+        self.assert_(self.staging.backup.startswith('a/data.backup-'))
+        self.assertEqual(self.staging.pool, None)
+
+        staging = StagedWrite(self.db, 'data/')
+        self.assertEqual(staging.name, 'data')
+        self.assert_(staging.staging.startswith('data.staging-'))
+
+        self.assertRaises(ValueError, StagedWrite, self.db, 'data', 0)
+
+    def testStore(self):
+        self.staging.store('d1', '<x/>')
+        self.staging.store('d2', '<y/>')
+        self.staging.pool.join()
+        staging = self.staging.staging
+        self.assertEqual(sorted(self.log), [('store', staging + '/d1', '<x/>'),
+                                            ('store', staging + '/d2', '<y/>')])
+
+    def testStoreFile(self):
+        fd, filename = tempfile.mkstemp('.xml')
+        try:
+            os.write(fd, '<z/>')
+            os.close(fd)
+            self.staging.store_file(filename)
+            self.staging.store_file(filename, 'other')
+            self.staging.pool.join()
+        finally:
+            os.remove(filename)
+        docname = os.path.splitext(os.path.basename(filename))[0]
+        staging = self.staging.staging
+        self.assertEqual(sorted(self.log),
+                         sorted([('store', staging + '/' + docname, '<z/>'),
+                                 ('store', staging + '/other', '<z/>')]))
+
+    def testCommit(self):
+        staging = self.staging.staging
+        backup  = self.staging.backup
+
+        # Nothing staged.
+        self.staging.commit()
+        self.assertEqual(self.log, [])
+
+        # The renames happen in order, after all uploads.
+        self.staging.store('d1', '<x/>')
+        self.staging.store('d2', '<y/>')
+        self.staging.commit()
+        self.assertEqual(self.log[2:],
+                         [('rename', 'a/data', backup.split('/')[-1]),
+                          ('rename', staging, 'data'),
+                          ('delete', backup)])
+
+        # The target collection does not exist yet.
+        del self.log[:]
+        self.existing = set()
+        with StagedWrite(self.db, 'new') as staged:
+            staged.store('d1', '<x/>')
+        self.assertEqual(self.log[1:], [('rename', staged.staging, 'new')])
+
+    def testCommitUploadError(self):
+        def store(name, xml):
+            self._store(name, xml)
+            raise ExistDB.Error('failed')
+        self.db.store = store
+        self.staging.store('d1', '<x/>')
+        self.assertRaises(ExistDB.Error, self.staging.commit)
+        self.assertEqual(self.log[1:], [('delete', self.staging.staging)])
+
+    def testStoreError(self):
+        release = threading.Event()
+        def store(name, xml):
+            release.wait()
+            self._store(name, xml)
+            raise ExistDB.Error('failed')
+        self.db.store = store
+        staging       = StagedWrite(self.db, 'a/data', threads = 1)
+        staging.store('d1', '<x/>')
+        staging.store('d2', '<y/>')
+        release.set()
+        for i in range(100):
+            if staging.pool.errors:
+                break
+            time.sleep(.01)
+
+        # Later calls fail fast, and the remaining uploads are skipped.
+        self.assertRaises(ExistDB.Error, staging.store, 'd3', '<z/>')
+        self.assertRaises(ExistDB.Error, staging.commit)
+        self.assertEqual(self.log, [('store', staging.staging + '/d1', '<x/>'),
+                                    ('delete', staging.staging)])
+
+    def testCommitCleanupError(self):
+        def delete(name):
+            raise ExistDB.Error('failed')
+        self.db.delete = delete
+        self.staging.store('d1', '<x/>')
+        with warnings.catch_warnings(record = True) as messages:
+            warnings.simplefilter('always')
+            self.staging.commit()
+        self.assertEqual(self.log[-1], ('rename', self.staging.staging, 'data'))
+        self.assertEqual(len(messages), 1)
+        self.assert_(self.staging.backup in str(messages[0].message))
+
+    def testCommitRenameError(self):
+        backup = self.staging.backup
+        def rename(name, new_name):
+            self._rename(name, new_name)
+            if name != 'a/data':
+                raise ExistDB.Error('failed')
+        self.db.rename = rename
+        self.staging.store('d1', '<x/>')
+        try:
+            self.staging.commit()
+        except ExistDB.Error, e:
+            self.assert_(backup in str(e))
+        else:
+            self.fail('commit() did not raise')
+
+    def testRollback(self):
+        # Nothing uploaded, so no requests are sent.
+        self.db.exists = None
+        self.staging.rollback()
+        self.assertEqual(self.log, [])
+
+        # An exception in the with-block removes the temporary collection.
+        self.db.exists = lambda name: name in self.existing
+        try:
+            with self.staging as staging:
+                staging.store('d1', '<x/>')
+                staging.pool.join()
+                raise ValueError()
+        except ValueError:
+            pass
+        else:
+            self.fail('exception was swallowed')
+        self.assertEqual(self.log[1:], [('delete', self.staging.staging)])
+
+        # Errors during the rollback do not hide the original exception.
+        def exists(name):
+            raise ExistDB.Error('connection failed')
+        self.db.exists = exists
+        staging = StagedWrite(self.db, 'a/data')
+        try:
+            with staging:
+                staging.store('d1', '<x/>')
+                raise ValueError()
+        except ValueError:
+            pass
+        else:
+            self.fail('exception was swallowed')
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(StagedWriteTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
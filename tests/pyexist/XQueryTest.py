@@ -0,0 +1,195 @@
+import sys, unittest, re, os.path, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from StringIO import StringIO
+from pyexist import ExistDB, XQuery
+
+class XQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.hits     = ['<item id="%d"><name>n%d</name></item>' % (i, i)
+                         for i in range(7)]
+        self.calls    = []
+        self.released = []
+        self.fail_at  = None
+        self.db       = ExistDB('localhost:8080/exist/rest/db', 'col')
+        self.db._post    = self._post
+        self.db._release = self.released.append
+        self.query       = XQuery(self.db, 'collection("col")/item')
+
+    def _post(self, query, start = 1, max = None, cache = False, session = None):
+        self.calls.append((start, max, cache, session))
+        if self.fail_at is not None and start >= self.fail_at:
+            raise ExistDB.Error('failed')
+        if max is None:
+            hits = self.hits[start - 1:]
+        else:
+            hits = self.hits[start - 1:start - 1 + max]
+        if cache:
+            session = ' exist:session="42"'
+        else:
+            session = ''
+        return '<exist:result xmlns:exist="%s" exist:hits="%d"%s>%s' \
+               '</exist:result>' % (ExistDB.RESULT_NS,
+                                    len(self.hits),
+                                    session,
+                                    ''.join(hits))
+
+    def _ids(self, elements):
+        return [int(e.get('id')) for e in elements]
+
+    def testPages(self):
+        pages = list(self.query.pages(3))
+        self.assertEqual([self._ids(p) for p in pages],
+                         [[0, 1, 2], [3, 4, 5], [6]])
+
+        # Empty results.
+        self.hits = []
+        self.assertEqual(list(self.query.pages(3)), [])
+
+    def testPagesSession(self):
+        list(self.query.pages(3))
+        self.assertEqual(self.calls, [(1, 3, True, None),
+                                      (4, 3, True, '42'),
+                                      (7, 3, True, '42')])
+        self.assertEqual(self.released, ['42'])
+        self.assertEqual(self.query.session, None)
+        self.assertEqual(self.query.cache, False)
+
+        # Plain slicing does not use a session.
+        del self.calls[:]
+        self.query[0:2]
+        self.assertEqual(self.calls, [(1, 2, False, None)])
+
+        # The session is released if the caller stops early.
+        del self.released[:]
+        pages = self.query.pages(3)
+        pages.next()
+        pages.close()
+        self.assertEqual(self.released, ['42'])
+
+    def testPagesReleaseError(self):
+        def release(session):
+            raise ExistDB.Error('release failed')
+        self.db._release = release
+
+        # Errors while releasing the session are ignored.
+        self.assertEqual(len(list(self.query.pages(3))), 3)
+
+        # The original error is not replaced.
+        self.fail_at = 4
+        try:
+            list(self.query.pages(3))
+        except ExistDB.Error, e:
+            self.assertEqual(str(e), 'failed')
+        else:
+            self.fail('pages() did not raise')
+
+    def _wait_for(self, condition, timeout = 5):
+        end = time.time() + timeout
+        while not condition():
+            if time.time() > end:
+                self.fail('timeout')
+            time.sleep(.01)
+
+    def testPrefetch(self):
+        result = self._ids(self.query.prefetch(page_size = 2, depth = 2))
+        self.assertEqual(result, range(7))
+        self.assertEqual(self.released, ['42'])
+
+        # Prefetched pages are the same as plain ones.
+        pages = list(self.query.pages(3, prefetch = 2))
+        self.assertEqual([self._ids(p) for p in pages],
+                         [[0, 1, 2], [3, 4, 5], [6]])
+
+    def testPrefetchError(self):
+        self.fail_at = 5
+        items        = self.query.prefetch(page_size = 2)
+        self.assertEqual(self._ids([items.next() for i in range(4)]),
+                         [0, 1, 2, 3])
+        self.assertRaises(ExistDB.Error, items.next)
+        self.assertEqual(self.released, ['42'])
+
+    def testPrefetchClose(self):
+        items = self.query.prefetch(page_size = 1, depth = 1)
+        items.next()
+        items.close()
+        self._wait_for(lambda: self.released)
+        self.assertEqual(self.released, ['42'])
+        self.assert_(len(self.calls) < len(self.hits))
+
+    def testPrefetchBound(self):
+        items = self.query.prefetch(page_size = 1, depth = 1)
+        items.next()
+
+        # One page was consumed, one waits in the queue, and one waits
+        # for a free slot in the queue; the producer fetches no more.
+        self._wait_for(lambda: len(self.calls) >= 3)
+        time.sleep(.1)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self._ids(items), range(1, 7))
+
+    def testExport(self):
+        progress = []
+        def callback(count, total):
+            progress.append((count, total))
+
+        out   = StringIO()
+        count = self.query.export(out, page_size = 3, progress = callback)
+        self.assertEqual(count, 7)
+        self.assertEqual(progress, [(3, 7), (6, 7), (7, 7)])
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], '<exist:result xmlns:exist="%s"'
+                                   ' exist:hits="7">' % ExistDB.RESULT_NS)
+        self.assertEqual(lines[1], '<item id="0"><name>n0</name></item>')
+        self.assertEqual(lines[-1], '</exist:result>')
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(self.released, ['42'])
+
+        # Empty results.
+        self.hits = []
+        out       = StringIO()
+        self.assertEqual(self.query.export(out), 0)
+        self.assertEqual(out.getvalue().splitlines(),
+                         ['<exist:result xmlns:exist="%s"'
+                          ' exist:hits="0">' % ExistDB.RESULT_NS,
+                          '</exist:result>'])
+
+        # Errors.
+        self.assertRaises(ValueError, self.query.export, out, 'json')
+
+    def testExportPrefetch(self):
+        self.hits = ['<item id="%d"/>' % i for i in range(7)]
+        out       = StringIO()
+        self.assertEqual(self.query.export(out,
+                                           'ndjson',
+                                           page_size = 2,
+                                           prefetch  = 1), 7)
+        self.assertEqual(out.getvalue().splitlines()[6], '{"@id": "6"}')
+
+    def testExportNdjson(self):
+        out = StringIO()
+        self.assertEqual(self.query.export(out, 'ndjson', page_size = 3), 7)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(lines[0], '{"@id": "0", "name": "n0"}')
+
+        out = StringIO()
+        self.query.export(out, 'ndjson', fields = ['name'])
+        self.assertEqual(out.getvalue().splitlines()[6], '{"name": "n6"}')
+
+    def testExportCsv(self):
+        out = StringIO()
+        self.assertEqual(self.query.export(out, 'csv', page_size = 3), 7)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[:2], ['@id,name', '0,n0'])
+        self.assertEqual(len(lines), 8)
+
+        out = StringIO()
+        self.query.export(out, 'csv', fields = ['name', '@id', 'missing'])
+        self.assertEqual(out.getvalue().splitlines()[:2],
+                         ['name,@id,missing', 'n0,0,'])
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(XQueryTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())
@@ -0,0 +1,104 @@
+import sys, unittest, re, os.path, threading, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from pyexist import util
+
+class utilTest(unittest.TestCase):
+    CORRELATE = util
+
+    def testEscape(self):
+        from pyexist.util import escape, safe
+        self.assertEqual(escape("it's"), "it''s")
+        self.assertEqual(escape(u"it's"), "it''s")
+        self.assertEqual(escape(safe("it's")), "it's")
+        self.assertEqual(escape(5), '5')
+        self.assertEqual(escape(['a', "b'"]), "'a', 'b'''")
+
+    def testReplacetags(self):
+        from pyexist.util import replacetags
+        result = replacetags("let $a := '%{a}' return %{b}", a = "x'y", b = 1)
+        self.assertEqual(result, "let $a := 'x''y' return 1")
+
+    def testParallel(self):
+        from pyexist.util import parallel
+        lock    = threading.Lock()
+        done    = []
+        running = [0, 0]
+        def func(item):
+            lock.acquire()
+            running[0] += 1
+            running[1]  = max(running)
+            lock.release()
+            time.sleep(.01)
+            lock.acquire()
+            running[0] -= 1
+            done.append(item)
+            lock.release()
+            if item % 3 == 0:
+                raise ValueError(item)
+
+        errors = parallel(func, range(10), threads = 3)
+        self.assertEqual(sorted(done), range(10))
+        self.assertEqual(sorted([i for i, e in errors]), [0, 3, 6, 9])
+        for item, e in errors:
+            self.assert_(isinstance(e, ValueError))
+        self.assert_(1 < running[1] <= 3)
+
+        # No items.
+        self.assertEqual(parallel(func, [], threads = 3), [])
+
+    def testWorkerPool(self):
+        from pyexist.util import WorkerPool
+        started = threading.Event()
+        release = threading.Event()
+        done    = []
+        def func(item):
+            started.set()
+            release.wait()
+            done.append(item)
+            if item == 2:
+                raise ValueError(item)
+
+        # The backlog is bounded.
+        pool = WorkerPool(func, threads = 1, backlog = 2)
+        pool.put(1)
+        started.wait()
+        pool.put(2)
+        pool.put(3)
+        self.assert_(pool.queue.full())
+        release.set()
+        errors = pool.join()
+        self.assertEqual(done, [1, 2, 3])
+        self.assertEqual([i for i, e in errors], [2])
+
+        # Cancelled items are skipped.
+        done = []
+        release.clear()
+        started.clear()
+        pool = WorkerPool(func, threads = 1)
+        pool.put(1)
+        started.wait()
+        pool.put(2)
+        pool.cancel()
+        release.set()
+        self.assertEqual(pool.join(), [])
+        self.assertEqual(done, [1])
+
+        # Errors cancel the pool if requested.
+        done = []
+        release.clear()
+        started.clear()
+        pool = WorkerPool(func, threads = 1, stop_on_error = True)
+        pool.put(2)
+        started.wait()
+        pool.put(3)
+        release.set()
+        self.assertEqual([i for i, e in pool.join()], [2])
+        self.assertEqual(done, [2])
+
+        self.assertRaises(ValueError, WorkerPool, func, threads = 0)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(utilTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity = 2).run(suite())